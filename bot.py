@@ -7,9 +7,10 @@
 
     Dependencies
     ============
-        requests>=2.20
+        aiohttp>=3.8
+        Brotli>=1.0
         discord.py>=2.1
-        beautifulsoup4>=4.11
+        lxml>=4.9
         python-dotenv>=0.20
 
     Config
@@ -31,20 +32,88 @@
         - `DEFAULT_WIKI_URL`
 '''
 
+import aiohttp
 import argparse
+import asyncio
+import collections
 import discord
 import discord.ext.tasks
 import dotenv
+import hashlib
 import logging
+import lxml.etree
+import lxml.html
 import os
-import requests
-import requests.adapters
-import urllib3.util.retry
-from bs4 import BeautifulSoup
+import pathlib
+import pickle
+import re
+import sys
+import unicodedata
 
 __version__ = '0.0.0-dev'
 
-dotenv.load_dotenv()
+
+class Client(discord.Client):
+    '''Discord client that owns the HTTP session for the wiki.'''
+
+    async def setup_hook(self):
+        global HTTP
+
+        HTTP = http_session()
+
+    async def close(self):
+        global HTTP
+
+        await super().close()
+        if HTTP is not None:
+            await HTTP.close()
+            HTTP = None
+
+
+INTENTS = discord.Intents()
+CLIENT = Client(intents=INTENTS)
+CODE_MEMO = set()
+LOGGER = logging.getLogger('dicord')
+# set from the command line and environment when `main` runs
+CONFIG = None
+# the channel never changes, so it's looked up once the client is ready
+CHANNEL = None
+# share a single session so the keep-alive connection is reused across polls
+HTTP = None
+# cache validators from the last response for conditional requests
+LAST_ETAG = None
+LAST_MODIFIED = None
+# digest of the last parsed body, for responses that change validators only
+LAST_DIGEST = None
+# compile the parsers and queries once, and skip building nodes we never use
+HTML_PARSERS = {}
+TABLE_XPATH = lxml.etree.XPath(
+    '//table[contains('
+    'concat(" ", normalize-space(@class), " "), " redeemcode "'
+    ')]'
+)
+ROWS_XPATH = lxml.etree.XPath('.//tr')
+CODE_RE = re.compile(r'[A-Za-z0-9]{4,24}')
+# the interval is configurable, so the task is created in `main`
+fetch_and_send_codes = None
+
+
+class Lazy:
+    '''Defer formatting a log argument until the record is emitted.'''
+
+    def __init__(self, function):
+        self.function = function
+
+    def __str__(self):
+        return self.function()
+
+
+def memo_text():
+    return Lazy(lambda: ', '.join(CODE_MEMO))
+
+
+def table_html(table):
+    return Lazy(lambda: lxml.html.tostring(table, encoding='unicode'))
 
 
 def get_environment_value(key, default=None):
@@ -52,168 +121,272 @@ def get_environment_value(key, default=None):
     return value or default
 
 
-DEFAULT_WIKI_URL = get_environment_value(
-    key='DEFAULT_WIKI_URL',
-    default='https://lovenikki.fandom.com/wiki/Category:Redeem_Code',
-)
-DEFAULT_APPLICATION_ID = get_environment_value(
-    key='DEFAULT_APPLICATION_ID',
-    default='1048611969034375198',
-)
-DEFAULT_PUBLIC_KEY = get_environment_value(
-    key='DEFAULT_PUBLIC_KEY',
-    default='5fdeee3dcbbf27e083bc1a9627b47d95a1dd8fe86c86270102c72a0ace66c5fc',
-)
-DISCORD_TOKEN = os.getenv('DISCORD_TOKEN')
-DISCORD_CHANNEL = os.getenv('DISCORD_CHANNEL')
-DEFAULT_INVERVAL = get_environment_value(
-    key='DEFAULT_INVERVAL',
-    default='240',
-)
-DEFAULT_MEMO_FILENAME = get_environment_value(
-    key='DEFAULT_MEMO_FILENAME',
-    default='redeem-codes.txt',
-)
-DEFAULT_LOG_LEVEL = os.getenv('DEFAULT_LOG_LEVEL')
-DEFAULT_LOG_FILE = os.getenv('DEFAULT_LOG_FILE')
-INTENTS = discord.Intents()
-CLIENT = discord.Client(intents=INTENTS)
-CODE_MEMO = set()
+def build_config():
+    '''Parse the environment and command line into the bot config.'''
 
-ARGPARSER = argparse.ArgumentParser(
-    description='Discord bot for Love Nikki Redeem Codes.',
-)
-ARGPARSER.add_argument(
-    '--application-id',
-    help='Application ID of the Discord bot.',
-    default=DEFAULT_APPLICATION_ID,
-)
-ARGPARSER.add_argument(
-    '--public-key',
-    help='Public key for the Discord bot user.',
-    default=DEFAULT_PUBLIC_KEY,
-)
-ARGPARSER.add_argument(
-    '--wiki-url',
-    help='URL to fetch the codes from the Love Nikki Wiki.',
-    default=DEFAULT_WIKI_URL,
-)
-ARGPARSER.add_argument(
-    '--discord-token',
-    help='Token for the Discord bot.',
-    default=DISCORD_TOKEN,
-)
-ARGPARSER.add_argument(
-    '--discord-channel',
-    help='Unique ID for the Discord channel.',
-    default=DISCORD_CHANNEL,
-)
-ARGPARSER.add_argument(
-    '--interval',
-    help='Interval (in minutes) to check for new redeem codes.',
-    type=int,
-    default=int(DEFAULT_INVERVAL),
-)
-ARGPARSER.add_argument(
-    '--memo-filename',
-    help='Filename to store the current memo at.',
-    default=DEFAULT_MEMO_FILENAME,
-)
-ARGPARSER.add_argument(
-    '--log-level',
-    help='Threshold level for the logger.',
-    default=DEFAULT_LOG_LEVEL,
-)
-ARGPARSER.add_argument(
-    '--log-file',
-    help='Path to file for the logger (None for stdout).',
-    default=DEFAULT_LOG_FILE,
-)
-ARGUMENTS = ARGPARSER.parse_args()
-LOGGER = logging.getLogger('dicord')
-if ARGUMENTS.log_file is not None:
-    HANDLER = logging.FileHandler(
-        filename=ARGUMENTS.log_file,
-        encoding='utf-8',
+    dotenv.load_dotenv()
+
+    default_wiki_url = get_environment_value(
+        key='DEFAULT_WIKI_URL',
+        default='https://lovenikki.fandom.com/wiki/Category:Redeem_Code',
+    )
+    default_application_id = get_environment_value(
+        key='DEFAULT_APPLICATION_ID',
+        default='1048611969034375198',
+    )
+    default_public_key = get_environment_value(
+        key='DEFAULT_PUBLIC_KEY',
+        default=(
+            '5fdeee3dcbbf27e083bc1a96'
+            '27b47d95a1dd8fe86c86270102c72a0ace66c5fc'
+        ),
     )
-else:
-    HANDLER = logging.StreamHandler()
-LOGGER.addHandler(HANDLER)
-if ARGUMENTS.log_level is not None:
-    LOGGER.setLevel(getattr(logging, ARGUMENTS.log_level.upper()))
+    discord_token = os.getenv('DISCORD_TOKEN')
+    discord_channel = os.getenv('DISCORD_CHANNEL')
+    default_interval = get_environment_value(
+        key='DEFAULT_INVERVAL',
+        default='240',
+    )
+    default_memo_filename = get_environment_value(
+        key='DEFAULT_MEMO_FILENAME',
+        default='redeem-codes.txt',
+    )
+    default_log_level = os.getenv('DEFAULT_LOG_LEVEL')
+    default_log_file = os.getenv('DEFAULT_LOG_FILE')
 
+    parser = argparse.ArgumentParser(
+        description='Discord bot for Love Nikki Redeem Codes.',
+    )
+    parser.add_argument(
+        '--application-id',
+        help='Application ID of the Discord bot.',
+        default=default_application_id,
+    )
+    parser.add_argument(
+        '--public-key',
+        help='Public key for the Discord bot user.',
+        default=default_public_key,
+    )
+    parser.add_argument(
+        '--wiki-url',
+        help='URL to fetch the codes from the Love Nikki Wiki.',
+        default=default_wiki_url,
+    )
+    parser.add_argument(
+        '--discord-token',
+        help='Token for the Discord bot.',
+        default=discord_token,
+    )
+    parser.add_argument(
+        '--discord-channel',
+        help='Unique ID for the Discord channel.',
+        default=discord_channel,
+    )
+    parser.add_argument(
+        '--interval',
+        help='Interval (in minutes) to check for new redeem codes.',
+        type=int,
+        default=int(default_interval),
+    )
+    parser.add_argument(
+        '--memo-filename',
+        help='Filename to store the current memo at.',
+        default=default_memo_filename,
+    )
+    parser.add_argument(
+        '--log-level',
+        help='Threshold level for the logger.',
+        default=default_log_level,
+    )
+    parser.add_argument(
+        '--log-file',
+        help='Path to file for the logger (None for stdout).',
+        default=default_log_file,
+    )
+    arguments = vars(parser.parse_args())
+    config_type = collections.namedtuple('Config', arguments)
 
-def retry_session(retries, session=None, backoff_factor=0.3):
-    '''Ensure a single request failure doesn't fail the bot.'''
+    return config_type(**arguments)
+
+
+def configure_logger(config):
+    '''Attach the log handler to the logger and return the handler.'''
+
+    if config.log_file is not None:
+        handler = logging.FileHandler(
+            filename=config.log_file,
+            encoding='utf-8',
+        )
+    else:
+        handler = logging.StreamHandler()
+    LOGGER.addHandler(handler)
+    if config.log_level is not None:
+        LOGGER.setLevel(getattr(logging, config.log_level.upper()))
 
-    session = session or requests.Session()
-    retry = urllib3.util.retry.Retry(
-        total=retries,
-        read=retries,
-        connect=retries,
-        backoff_factor=backoff_factor,
-        allowed_methods=('get'),
+    return handler
+
+
+def http_session():
+    '''Create the HTTP session, which must be done within a running loop.'''
+
+    connector = aiohttp.TCPConnector(limit=4, keepalive_timeout=300)
+    # aiohttp transparently decodes brotli responses if `Brotli` is installed
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={
+            'Accept': 'text/html',
+            'Accept-Encoding': 'br, gzip',
+            'User-Agent': f'redeem-code/{__version__}',
+        },
     )
-    adapter = requests.adapters.HTTPAdapter(max_retries=retry)
-    session.mount('http://', adapter)
-    session.mount('https://', adapter)
-    return session
 
 
-def get_redeem_code_table(url):
-    '''Get the HTML table containing the redeem codes.'''
+async def retry_get(url, headers, retries=5, backoff_factor=0.3):
+    '''Ensure a single request failure doesn't fail the bot.'''
 
-    session = retry_session(retries=5)
-    response = session.get(url)
-    response.raise_for_status()
-    content = response.content
-    soup = BeautifulSoup(content, 'html.parser')
-    elements = soup.select('table.redeemcode')
+    for attempt in range(retries + 1):
+        try:
+            async with HTTP.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return response, None
+                response.raise_for_status()
+                return response, await response.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if attempt == retries:
+                raise
+            await asyncio.sleep(backoff_factor * 2**attempt)
+
+
+def html_parser(encoding):
+    '''Get the cached HTML parser for the response charset.'''
+
+    parser = HTML_PARSERS.get(encoding)
+    if parser is None:
+        try:
+            parser = lxml.html.HTMLParser(
+                encoding=encoding,
+                remove_blank_text=True,
+                remove_comments=True,
+            )
+        except LookupError:
+            LOGGER.warning('Ignoring unknown response charset %r', encoding)
+            parser = html_parser(None)
+        HTML_PARSERS[encoding] = parser
+    return parser
+
+
+def parse_redeem_code_table(content, encoding=None):
+    '''
+    Parse the HTML table containing the redeem codes.
+
+    The encoding is the charset from the response headers. If it's None,
+    libxml2 detects it from the document instead.
+    '''
+
+    tree = lxml.html.fromstring(content, parser=html_parser(encoding))
+    elements = TABLE_XPATH(tree)
     if len(elements) != 1:
-        msg = f'Got unexpected number of items, raw HTML output is "{content}"'
-        LOGGER.error(msg)
+        msg = 'Got unexpected number of items'
+        LOGGER.error('%s, raw HTML output is "%s"', msg, content)
         raise ValueError(msg)
     return elements[0]
 
 
-def get_table_row_text(row):
-    '''Extract the table row data if the header matches the condition'''
-
-    header = row.find(name='th')
-    if header is None:
-        return
-    header_text = header.text.strip()
-
-    data = row.find(name='td')
-    if data is None:
-        return
-    data_text = data.text.strip()
-
-    return (header_text, data_text)
+def cache_validators(validators):
+    '''Store the validators for the next conditional request.'''
+
+    global LAST_ETAG, LAST_MODIFIED, LAST_DIGEST
+
+    if validators is not None:
+        LAST_ETAG, LAST_MODIFIED, LAST_DIGEST = validators
+
+
+async def get_redeem_code_table(url):
+    '''
+    Get the HTML table containing the redeem codes and the validators.
+
+    The table is None if the page has not changed since the last fetch,
+    either from a `304 Not Modified` response or an identical body. The
+    validators are None for a `304 Not Modified` response, otherwise they
+    should be cached with `cache_validators` once the table is processed.
+    '''
+
+    headers = {}
+    if LAST_ETAG is not None:
+        headers['If-None-Match'] = LAST_ETAG
+    if LAST_MODIFIED is not None:
+        headers['If-Modified-Since'] = LAST_MODIFIED
+    response, content = await retry_get(url, headers)
+    if content is None:
+        return None, None
+
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    if digest != LAST_DIGEST:
+        # parsing is CPU-bound, so keep it off the event loop
+        table = await asyncio.to_thread(
+            parse_redeem_code_table,
+            content,
+            response.charset,
+        )
+    else:
+        table = None
+
+    validators = (
+        response.headers.get('ETag'),
+        response.headers.get('Last-Modified'),
+        digest,
+    )
+    return table, validators
 
 
-def chunks_exact(iterable, interval):
-    chunk = []
-    for item in iterable:
-        chunk.append(item)
-        if len(chunk) == interval:
-            yield chunk
-            chunk = []
+def is_code_row(row):
+    '''Validate the table row header is for the redeem code.'''
 
-    if chunk:
-        msg = f'Did not exact interval, had {len(chunk)} leftover items'
-        LOGGER.error(msg)
-        raise ValueError(msg)
+    header = row.find('th')
+    if header is None:
+        return False
+    return header.text_content().strip() == 'Code'
 
 
-def parse_chunked_rows(chunk):
-    data = {}
-    for row in chunk:
-        row_data = get_table_row_text(row)
-        if row_data is not None:
-            data[row_data[0]] = row_data[1]
+def get_code(row, table):
+    '''Extract the redeem code from the table row, or None if invalid.'''
 
-    return data
+    data = row.find('td')
+    if data is None:
+        message = 'Got invalid for data for table'
+        LOGGER.error('%s "%s"', message, table_html(table))
+        raise ValueError(message)
+    # the wiki can pad codes with non-breaking spaces, which `strip`
+    # removes, or invisible format characters, such as zero-width spaces
+    text = data.text_content()
+    code = ''.join(i for i in text if unicodedata.category(i) != 'Cf').strip()
+    if CODE_RE.fullmatch(code) is None:
+        LOGGER.warning('Skipping invalid redeem code %r', code)
+        return None
+    # intern the codes so memo lookups can short-circuit on identity
+    return sys.intern(code)
+
+
+def write_memo(filename, codes):
+    '''Atomically replace the memo file with the pickled codes.'''
+
+    # write the serialized buffer directly to the descriptor, without
+    # copying it through a buffered file, then sync and rename the
+    # temporary file so a crash can't corrupt the memo
+    data = memoryview(pickle.dumps(frozenset(codes), protocol=5))
+    temporary = f'{filename}.tmp'
+    fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        try:
+            while data:
+                data = data[os.write(fd, data):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.unlink(temporary)
+        raise
 
 
 def get_redeem_codes(table, memo):
@@ -231,63 +404,95 @@ def get_redeem_codes(table, memo):
     #   </tbody>
     # </table>
 
-    added = []
-    current = set()
-
-    rows = table.find_all(name='tr')
-    if rows is None:
-        return added
-    elif (len(rows) - 1) % 3 != 0:
-        msg = f'Expected 1 + 3*N rows, instead got table output of "{table}"'
-        LOGGER.error(msg)
+    rows = ROWS_XPATH(table)
+    if (len(rows) - 1) % 3 != 0:
+        msg = f'Expected 1 + 3*N rows, instead got {len(rows)}'
+        LOGGER.error('%s, table output is "%s"', msg, table_html(table))
         raise ValueError(msg)
 
-    for chunk in chunks_exact(rows[1:], 3):
-        code_data = parse_chunked_rows(chunk)
-        if 'Code' not in code_data:
-            message = f'Got invalid for data for table "{table}"'
-            LOGGER.error(message)
-            raise ValueError(message)
-        code = code_data['Code']
-        current.add(code)
-        if code not in memo:
-            added.append(code)
+    # the row layout is fixed, so only the first row of each group matters
+    code_rows = rows[1::3]
+    if __debug__ and not all(is_code_row(row) for row in code_rows):
+        message = 'Got invalid for data for table'
+        LOGGER.error('%s "%s"', message, table_html(table))
+        raise ValueError(message)
 
+    codes = (get_code(row, table) for row in code_rows)
+    current = {code for code in codes if code is not None}
+    added = sorted(current - memo)
+    if current == memo:
+        return added
+
+    # only update the memo once it's saved, so a failed write is retried
+    write_memo(CONFIG.memo_filename, current)
     memo.clear()
     memo.update(current)
-    with open(ARGUMENTS.memo_filename, 'w') as file:
-        file.write('\n'.join(sorted(current)))
 
     return added
 
 
+def format_messages(header, items, delimiter, limit=1900):
+    '''
+    Format the items into messages under Discord's 2000 character limit.
+
+    Every message is prefixed with the header, since messages sent
+    concurrently are not guaranteed to arrive in order.
+    '''
+
+    messages = []
+    message = header
+    for item in items:
+        entry = delimiter + item
+        if message != header and len(message) + len(entry) > limit:
+            messages.append(message)
+            message = header
+        message += entry
+    messages.append(message)
+
+    return messages
+
+
 @CLIENT.event
 async def on_ready():
+    global CHANNEL
+
     LOGGER.info('Starting up Discord client at `on_ready`.')
 
+    if CHANNEL is None:
+        # prefer the client cache, which avoids an API request
+        CHANNEL = CLIENT.get_channel(int(CONFIG.discord_channel))
+        if CHANNEL is None:
+            CHANNEL = await CLIENT.fetch_channel(CONFIG.discord_channel)
+
     if not fetch_and_send_codes.is_running():
         fetch_and_send_codes.start()
         LOGGER.info('Started fetch and send codes bot.')
 
 
-@discord.ext.tasks.loop(minutes=ARGUMENTS.interval)
-async def fetch_and_send_codes():
+async def fetch_and_send_codes_impl():
     LOGGER.info('Attempting to fetch redeem codes.')
 
-    channel = await CLIENT.fetch_channel(ARGUMENTS.discord_channel)
-    table = get_redeem_code_table(ARGUMENTS.wiki_url)
-    added = get_redeem_codes(table, CODE_MEMO)
-    memo = ', '.join(CODE_MEMO)
-    LOGGER.info(f'Fetched codes and have current memo of [{memo}]')
+    table, validators = await get_redeem_code_table(CONFIG.wiki_url)
+    if table is None:
+        LOGGER.info('Redeem code page is unchanged, skipping parsing.')
+        cache_validators(validators)
+        return
+    # writing the memo is blocking, so keep it off the event loop
+    added = await asyncio.to_thread(get_redeem_codes, table, CODE_MEMO)
+    # only cache the validators once the memo is saved, so a failed
+    # poll fetches and processes the page again on the next iteration
+    cache_validators(validators)
+    LOGGER.info('Fetched codes and have current memo of [%s]', memo_text())
     if added:
-        delimiter = '\n  • '
-        formatted = delimiter + delimiter.join(added)
-        message = f'@redeemcodes Newly added redeem codes are: {formatted}'
-        LOGGER.info(f'Sending channel message of {repr(message)}.')
-        await channel.send(message)
+        messages = format_messages(
+            header='@redeemcodes Newly added redeem codes are: ',
+            items=added,
+            delimiter='\n  • ',
+        )
+        LOGGER.info('Sending channel messages of %r.', messages)
+        await asyncio.gather(*(CHANNEL.send(i) for i in messages))
 
 
-@fetch_and_send_codes.before_loop
 async def wait_login():
     LOGGER.info('Waiting for client login')
     await CLIENT.wait_until_ready()
@@ -295,23 +500,39 @@ async def wait_login():
 
 
 def main():
-    if ARGUMENTS.discord_token is None:
+    global CONFIG, fetch_and_send_codes
+
+    CONFIG = build_config()
+    handler = configure_logger(CONFIG)
+    fetch_and_send_codes = discord.ext.tasks.loop(minutes=CONFIG.interval)(
+        fetch_and_send_codes_impl,
+    )
+    fetch_and_send_codes.before_loop(wait_login)
+
+    if CONFIG.discord_token is None:
         message = 'Did not provide Discord bot token.'
         LOGGER.fatal(message)
         raise ValueError(message)
-    if ARGUMENTS.discord_channel is None:
+    if CONFIG.discord_channel is None:
         message = 'Did not provide Discord channel ID.'
         LOGGER.fatal(message)
         raise ValueError(message)
 
-    if os.path.exists(ARGUMENTS.memo_filename):
-        with open(ARGUMENTS.memo_filename) as file:
-            redeem_codes = file.read().splitlines()
-            # can get extra newlines or empty entries
-            CODE_MEMO.update([i for i in redeem_codes if i])
-
-    LOGGER.info(f'Started Discord bot with codes of [{", ".join(CODE_MEMO)}]')
-    CLIENT.run(ARGUMENTS.discord_token, log_handler=HANDLER)
+    try:
+        data = pathlib.Path(CONFIG.memo_filename).read_bytes()
+    except FileNotFoundError:
+        data = b''
+    # pickles with protocol 2+ start with the PROTO opcode, anything
+    # else is the legacy newline-delimited text format, which can
+    # have extra newlines or empty entries
+    if data.startswith(pickle.PROTO):
+        redeem_codes = pickle.loads(data)
+    else:
+        redeem_codes = data.decode('utf-8').split()
+    CODE_MEMO.update(map(sys.intern, redeem_codes))
+
+    LOGGER.info('Started Discord bot with codes of [%s]', memo_text())
+    CLIENT.run(CONFIG.discord_token, log_handler=handler)
 
 
 if __name__ == '__main__':